@@ -10,10 +10,15 @@ __all__ = [
 ]
 
 import collections
+import concurrent.futures as futures
+import functools
+import io
 import itertools as it
 import os
 import random
 import re
+import shutil
+import wave
 
 import numpy as np
 
@@ -26,6 +31,32 @@ from sisyphus import *
 Path = setup_path(__package__)
 
 
+@functools.lru_cache(maxsize=None)
+def _wav_duration(path):
+    """
+    :param str path: path to a wav file
+    :return: duration of the audio in seconds, cached as many segments share one recording
+    :rtype: float
+    """
+    with wave.open(path) as afile:
+        return afile.getnframes() / afile.getframerate()
+
+
+def _run_concurrently(func, args_list, max_workers=32):
+    """
+    Writing many output files mostly waits for the (network) file system, so run the writes in threads
+
+    :param (...) -> None func: function to call
+    :param list[tuple] args_list: positional arguments for each call of func
+    :param int max_workers: maximum number of threads
+    """
+    num_workers = max(1, min(max_workers, len(args_list)))
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = [executor.submit(func, *args) for args in args_list]
+        for future in pending:
+            future.result()  # re-raises exceptions of the worker threads
+
+
 class SegmentCorpusJob(Job):
     def __init__(self, bliss_corpus, num_segments):
         self.set_vis_name("Segment Corpus")
@@ -48,13 +79,18 @@ class SegmentCorpusJob(Job):
 
         all_segments = list(c.segments())
 
-        for idx, segments in enumerate(chunks(all_segments, self.num_segments)):
+        def write_segment_file(idx, segments):
             with open(
-                self.out_single_segment_files[idx + 1].get_path(), "wt"
+                self.out_single_segment_files[idx].get_path(), "wt"
             ) as segment_file:
                 for segment in segments:
                     segment_file.write(segment.fullname() + "\n")
 
+        _run_concurrently(
+            write_segment_file,
+            list(enumerate(chunks(all_segments, self.num_segments), 1)),
+        )
+
 
 class SegmentCorpusBySpeakerJob(Job):
     def __init__(self, bliss_corpus, num_speakers=None):
@@ -84,25 +120,29 @@ class SegmentCorpusBySpeakerJob(Job):
             speaker_map[speaker].append(segment.fullname())
 
         self.out_num_speakers.set(len(speaker_map))
+        speakers = sorted(speaker_map)
+
+        def write_speaker_file(idx, speaker):
+            with open(
+                os.path.join(self.out_segment_dir.get_path(), "speaker.%d" % idx),
+                "wt",
+            ) as ssf:
+                ssf.write("\n".join(speaker_map[speaker]) + "\n")
+
+        _run_concurrently(write_speaker_file, list(enumerate(speakers, 1)))
 
         with open(self.out_speaker_map_file.get_path(), "wt") as smf:
             with open(self.out_cluster_map_file.get_path(), "wt") as cmf:
                 cmf.write('<?xml version="1.0" encoding="utf-8" ?>\n')
                 cmf.write("<coprus-key-map>\n")  # misspelled on purpose
-                for idx, speaker in enumerate(sorted(speaker_map), 1):
+                for idx, speaker in enumerate(speakers, 1):
                     smf.write("%s\n" % speaker)
-                    with open(
-                        os.path.join(
-                            self.out_segment_dir.get_path(), "speaker.%d" % idx
-                        ),
-                        "wt",
-                    ) as ssf:
-                        for segment in speaker_map[speaker]:
-                            ssf.write("%s\n" % segment)
-                            cmf.write(
-                                '  <map-item key="%s" value="cluster.%d"/>\n'
-                                % (segment, idx)
-                            )
+                    cmf.write(
+                        "".join(
+                            f'  <map-item key="{segment}" value="cluster.{idx}"/>\n'
+                            for segment in speaker_map[speaker]
+                        )
+                    )
                 cmf.write("</coprus-key-map>")  # misspelled on purpose
 
 
@@ -131,68 +171,100 @@ class SegmentCorpusByRegexJob(Job):
     def run(self):
         c = corpus.Corpus()
         c.load(self.bliss_corpus.get_path())
-        speaker_map = {}
+        speaker_map = collections.defaultdict(list)
+        search = self.regex.search
+        use_fullpath = self.use_fullpath
+        get_speaker = self._speaker_extractor()
         for segment in c.segments():
-            if self.use_fullpath:
-                match = self.regex.search(segment.fullname())
+            fullname = segment.fullname()
+            if use_fullpath:
+                match = search(fullname)
             else:
-                match = self.regex.search(segment.name)
-            if match is not None:
-                if len(match.groups()) > 0:
-                    speaker = ""
-                    for g in self.groups:
-                        if match.group(g) is not None:
-                            speaker += match.group(g)
-                else:
-                    speaker = match.group(0)
-            else:
-                speaker = "unknown"
-
-            if speaker not in speaker_map.keys():
-                speaker_map[speaker] = []
+                match = search(segment.name)
+            speaker = get_speaker(match) if match is not None else "unknown"
 
-            speaker_map[speaker].append(segment.fullname())
+            speaker_map[speaker].append(fullname)
 
         self.out_num_speakers.set(len(speaker_map))
+        speakers = sorted(speaker_map)
+
+        def write_speaker_file(idx, speaker):
+            with open(
+                os.path.join(self.out_segment_dir.get_path(), "speaker.%d" % idx),
+                "wt",
+            ) as ssf:
+                ssf.write("\n".join(speaker_map[speaker]) + "\n")
+
+        _run_concurrently(write_speaker_file, list(enumerate(speakers, 1)))
 
         with open(self.out_speaker_map_file.get_path(), "wt") as smf:
             with open(self.out_cluster_map_file.get_path(), "wt") as cmf:
                 cmf.write('<?xml version="1.0" encoding="utf-8" ?>\n')
                 cmf.write("<coprus-key-map>\n")  # misspelled on purpose
-                for idx, speaker in enumerate(sorted(speaker_map), 1):
+                for idx, speaker in enumerate(speakers, 1):
                     smf.write("%s\n" % speaker)
-                    with open(
-                        os.path.join(
-                            self.out_segment_dir.get_path(), "speaker.%d" % idx
-                        ),
-                        "wt",
-                    ) as ssf:
-                        for segment in speaker_map[speaker]:
-                            ssf.write("%s\n" % segment)
-                            cmf.write(
-                                '  <map-item key="%s" value="cluster.%d"/>\n'
-                                % (segment, idx)
-                            )
+                    cmf.write(
+                        "".join(
+                            f'  <map-item key="{segment}" value="cluster.{idx}"/>\n'
+                            for segment in speaker_map[speaker]
+                        )
+                    )
                 cmf.write("</coprus-key-map>")  # misspelled on purpose
 
+    def _speaker_extractor(self):
+        """
+        The number of groups is fixed by the compiled regex, so decide only once how the speaker is built
+
+        :return: function mapping a match to the speaker name
+        :rtype: (re.Match) -> str
+        """
+        if self.regex.groups > 0:
+            groups = self.groups
+
+            def get_speaker(match):
+                # concatenate all matched groups, unmatched (None) groups are skipped
+                return "".join(filter(None, map(match.group, groups)))
+
+        else:
+
+            def get_speaker(match):
+                return match.group(0)
+
+        return get_speaker
+
 
 class ShuffleAndSplitSegmentsJob(Job):
     default_split = {"train": 0.9, "dev": 0.1}
 
     def __init__(
-        self, segment_file, split=None, shuffle=True, shuffle_seed=0x3C5EA3E47D4E0077
+        self,
+        segment_file,
+        split=None,
+        shuffle=True,
+        shuffle_seed=0x3C5EA3E47D4E0077,
+        shuffle_impl="random",
     ):
+        """
+        :param tk.Path segment_file: segment file
+        :param dict[str, float]|None split: fraction of segments per split name, has to sum up to 1
+        :param bool shuffle: shuffle the segments before splitting
+        :param int shuffle_seed: random number seed
+        :param str shuffle_impl: "random" for python's random.Random or "numpy" for a faster numpy permutation,
+            the resulting order differs between the two, so only "numpy" is hashed
+        """
         if split is None:
             split = dict(**self.default_split)
 
         assert isinstance(split, dict)
         assert all(s > 0 for s in split.values())
         assert abs(sum(split.values()) - 1.0) < 1e-10
+        assert shuffle_impl in ["random", "numpy"]
 
         self.segment_file = segment_file
         self.split = split
         self.shuffle = shuffle
         self.shuffle_seed = shuffle_seed
+        self.shuffle_impl = shuffle_impl
 
         self.out_segments = {
             k: self.output_path("%s.segments" % k) for k in self.split.keys()
@@ -202,15 +274,42 @@ class ShuffleAndSplitSegmentsJob(Job):
         yield Task("run", mini_task=True)
 
     def run(self):
-        with open(self.segment_file.get_path()) as f:
-            segments = f.readlines()
+        segment_path = self.segment_file.get_path()
 
         if self.shuffle:
-            rng = random.Random(self.shuffle_seed)
-            rng.shuffle(segments)
-
+            with open(segment_path) as in_file:
+                segments = in_file.readlines()
+            # jobs pickled before shuffle_impl was added used random.Random
+            if getattr(self, "shuffle_impl", "random") == "numpy":
+                rng = np.random.default_rng(self.shuffle_seed)
+                perm = rng.permutation(len(segments))
+                segments = [segments[i] for i in perm.tolist()]
+            else:
+                rng = random.Random(self.shuffle_seed)
+                rng.shuffle(segments)
+            self._write_splits(iter(segments), len(segments), "wt")
+            return
+
+        # no need to keep the segments in memory, count them and stream the file again
+        n, has_cr = self._count_lines(segment_path)
+        if has_cr:
+            # text mode treats \r as line break and converts it, keep that behavior
+            with open(segment_path, "rt") as in_file:
+                n = sum(1 for _ in in_file)
+                in_file.seek(0)
+                self._write_splits(in_file, n, "wt")
+        else:
+            # text mode would not change the content, so directly copy the bytes
+            with open(segment_path, "rb") as in_file:
+                self._write_splits(in_file, n, "wb")
+
+    def _write_splits(self, lines, n, mode):
+        """
+        :param Iterator[str]|Iterator[bytes] lines: all segment lines, a file object is copied directly for the last split
+        :param int n: number of lines
+        :param str mode: mode to open the output files with
+        """
         ordered_keys = sorted(self.split.keys())
-        n = len(segments)
         split_idx = [0] + [
             int(n * c) for c in it.accumulate(self.split[k] for k in ordered_keys)
         ]
@@ -219,8 +318,29 @@ class ShuffleAndSplitSegmentsJob(Job):
         ] = n  # just in case we get numeric errors that drop the last element
 
         for i, k in enumerate(ordered_keys):
-            with open(self.out_segments[k].get_path(), "wt") as f:
-                f.writelines(segments[split_idx[i] : split_idx[i + 1]])
+            with open(self.out_segments[k].get_path(), mode) as f:
+                if i == len(ordered_keys) - 1 and isinstance(lines, io.IOBase):
+                    shutil.copyfileobj(lines, f)
+                else:
+                    f.writelines(it.islice(lines, split_idx[i + 1] - split_idx[i]))
+
+    @staticmethod
+    def _count_lines(path):
+        """
+        :param str path:
+        :return: number of lines in the file and if it contains any \r
+        :rtype: tuple[int, bool]
+        """
+        num_lines = 0
+        has_cr = False
+        block = b""
+        with open(path, "rb") as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b""):
+                num_lines += block.count(b"\n")
+                has_cr = has_cr or b"\r" in block
+        if block and not block.endswith(b"\n"):
+            num_lines += 1  # last line without line break
+        return num_lines, has_cr
 
     @classmethod
     def hash(cls, kwargs):
@@ -232,6 +352,8 @@ class ShuffleAndSplitSegmentsJob(Job):
                 for k, v in split.items()
             ):
                 kwargs_copy["split"] = None
+        if kwargs_copy["shuffle_impl"] == "random":
+            del kwargs_copy["shuffle_impl"]
 
         return super().hash(kwargs_copy)
 
@@ -253,17 +375,17 @@ class SplitSegmentFileJob(Job):
         yield Task("run", resume="run", mini_task=True)
 
     def run(self):
-        with open(self.segment_file.get_path(), "rt") as f:
-            lines = [l for l in f.readlines() if len(l.strip()) > 0]
+        with open(self.segment_file.get_path(), "rt") as in_file:
+            # lines read from a file are never empty, isspace avoids creating stripped copies
+            n = sum(1 for l in in_file if not l.isspace())
+            in_file.seek(0)
+            lines = (l for l in in_file if not l.isspace())
 
-        n = len(lines)
-        m = n % self.concurrent
-        end = 0
-        for i in range(1, self.concurrent + 1):
-            start = end
-            end += n // self.concurrent + (1 if i <= m else 0)
-            with open(self.out_single_segments[i].get_path(), "wt") as f:
-                f.writelines(lines[start:end])
+            m = n % self.concurrent
+            for i in range(1, self.concurrent + 1):
+                num_lines = n // self.concurrent + (1 if i <= m else 0)
+                with open(self.out_single_segments[i].get_path(), "wt") as f:
+                    f.writelines(it.islice(lines, num_lines))
 
 
 class DynamicSplitSegmentFileJob(Job):
@@ -287,7 +409,7 @@ class DynamicSplitSegmentFileJob(Job):
 
     def run(self):
         with uopen(self.segment_file, "rt") as f:
-            lines = [l for l in f.readlines() if len(l.strip()) > 0]
+            lines = [l for l in f if not l.isspace()]
 
         nb_seg = len(lines)
         self.concurrent = self.concurrent.get()
@@ -321,7 +443,7 @@ class SortSegmentsByLengthAndShuffleJob(Job):
 
     def run(self):
         with open(tk.uncached_path(self.crp.segment_path)) as f:
-            segments = f.read().splitlines()
+            segments = set(f.read().splitlines())
 
         corpus_path = tk.uncached_path(self.crp.corpus_config.file)
         c = corpus.Corpus()
@@ -329,33 +451,36 @@ class SortSegmentsByLengthAndShuffleJob(Job):
         print(corpus_path)
 
         segment_dict = {}
+        # the corpus order is kept as it determines the shuffling result,
+        # but there is no need to continue once all listed segments were found
+        remaining = set(segments)
         for segment in c.segments():
-            if segment.fullname() in segments:
+            if not remaining:
+                break
+            fullname = segment.fullname()
+            if fullname in segments:
+                remaining.discard(fullname)
                 if np.isinf(segment.end):
                     if segment.recording.audio[-4:] == ".wav":
-                        import wave
-
-                        with wave.open(segment.recording.audio) as afile:
-                            segment_dict[segment.fullname() + "\n"] = (
-                                afile.getnframes() / afile.getframerate()
-                            )
+                        segment_dict[fullname + "\n"] = _wav_duration(
+                            segment.recording.audio
+                        )
                 else:
-                    segment_dict[segment.fullname() + "\n"] = (
-                        segment.end - segment.start
-                    )
+                    segment_dict[fullname + "\n"] = segment.end - segment.start
 
-        probs = np.exp(
-            -self.shuffle_strength * np.fromiter(segment_dict.values(), dtype=float)
-        )
+        keys = list(segment_dict.keys())
+        probs = np.fromiter(segment_dict.values(), dtype=float, count=len(keys))
+        probs *= -self.shuffle_strength
+        np.exp(probs, out=probs)
         probs /= np.sum(probs)
 
-        np.random.seed(self.shuffle_seed)
-        seglist = np.random.choice(
-            list(segment_dict.keys()), size=len(probs), replace=False, p=probs
-        )
+        # sample indices instead of the keys themselves to avoid building an object array,
+        # the legacy RandomState keeps the output identical to seeding the global generator
+        rng = np.random.RandomState(self.shuffle_seed)
+        seg_idx = rng.choice(len(keys), size=len(keys), replace=False, p=probs)
 
         with open(self.out_segments.get_path(), "wt") as f:
-            f.writelines(seglist)
+            f.writelines(keys[i] for i in seg_idx)
 
 
 class UpdateSegmentsWithSegmentMapJob(Job):
@@ -380,13 +505,14 @@ class UpdateSegmentsWithSegmentMapJob(Job):
         sm = corpus.SegmentMap()
         sm.load(self.segment_map.get_path())
 
-        segment_map_dict = {}
-        for map_item in sm.map_entries:
-            segment_map_dict[map_item.key] = map_item.value
+        # store the final output lines, so that each segment only needs a single lookup
+        segment_map_dict = {
+            map_item.key: map_item.value.strip() + "\n" for map_item in sm.map_entries
+        }
 
         with open(self.segment_file.get_path(), "rt") as in_segments, open(
             self.out_segments.get_path(), "wt"
         ) as out_segments:
-            for in_segment in in_segments:
-                out_segment = segment_map_dict[in_segment.strip()].strip()
-                out_segments.write(out_segment + "\n")
+            out_segments.writelines(
+                segment_map_dict[in_segment.strip()] for in_segment in in_segments
+            )
@@ -2,8 +2,8 @@ __all__ = ["CodeWrapper", "ReturnnConfig", "WriteReturnnConfigJob"]
 
 import base64
 import black
+import functools
 import inspect
-import json
 import os
 import pickle
 import pprint
@@ -17,6 +17,11 @@ from sisyphus.hash import sis_hash_helper
 Path = setup_path(__package__)
 Variable = tk.Variable
 
+# types that can not contain a DelayedBase and are returned directly by instanciate_delayed
+_ATOMIC_TYPES = frozenset({str, bytes, int, float, bool, type(None)})
+# atomic types whose equal values have equal reprs, floats are excluded as e.g. 0.0 == -0.0
+_CACHED_FORMAT_TYPES = _ATOMIC_TYPES - {float}
+
 
 def instanciate_delayed(o):
     """
@@ -26,19 +31,36 @@ def instanciate_delayed(o):
     :param Any o: nested structure that may contain DelayedBase objects
     :return:
     """
+    if type(o) in _ATOMIC_TYPES:
+        return o
     if isinstance(o, DelayedBase):
         o = o.get()
     elif isinstance(o, list):
-        for k in range(len(o)):
-            o[k] = instanciate_delayed(o[k])
+        for k, v in enumerate(o):
+            new_v = instanciate_delayed(v)
+            if new_v is not v:
+                o[k] = new_v
     elif isinstance(o, tuple):
         o = tuple(instanciate_delayed(e) for e in o)
     elif isinstance(o, dict):
-        for k in o:
-            o[k] = instanciate_delayed(o[k])
+        for k, v in o.items():
+            new_v = instanciate_delayed(v)
+            if new_v is not v:
+                o[k] = new_v
     return o
 
 
+@functools.lru_cache(maxsize=None)
+def _get_source(obj):
+    """
+    Cached inspect.getsource, as the same functions and classes are often serialized into many configs
+
+    :param function|type obj:
+    :rtype: str
+    """
+    return inspect.getsource(obj)
+
+
 class CodeWrapper:
     def __init__(self, code):
         self.code = code
@@ -47,6 +69,43 @@ class CodeWrapper:
         return self.code
 
 
+class _ReadabilityPrettyPrinter(pprint.PrettyPrinter):
+    """
+    PrettyPrinter that keeps track of the readability of the formatted object,
+    so that the object does not need to be traversed a second time by pprint.isreadable
+    """
+
+    def pformat_readable(self, obj):
+        """
+        :param Any obj:
+        :return: formatted object and if it is readable in the sense of pprint.isreadable
+        :rtype: tuple[str, bool]
+        """
+        self._is_readable = True
+        return self.pformat(obj), self._is_readable
+
+    def format(self, obj, context, maxlevels, level):
+        rep, readable, recursive = super().format(obj, context, maxlevels, level)
+        if not readable or recursive:
+            self._is_readable = False
+        return rep, readable, recursive
+
+
+@functools.lru_cache(maxsize=4096)
+def _pformat_atomic(value_type, value, pprint_kwargs):
+    """
+    Cached formatting of atomic config values, which repeat a lot when writing many similar configs
+
+    :param type value_type: part of the cache key, as e.g. 1, 1.0 and True are equal
+    :param str|bytes|int|bool|None value:
+    :param tuple[tuple[str, Any]] pprint_kwargs: sorted items of the pprint kwargs
+    :return: formatted value and if it is readable
+    :rtype: tuple[str, bool]
+    """
+    pp = _ReadabilityPrettyPrinter(indent=2, width=150, **dict(pprint_kwargs))
+    return pp.pformat_readable(value)
+
+
 class ReturnnConfig:
     """
     An object that manages a RETURNN config.
@@ -149,11 +208,12 @@ class ReturnnConfig:
         write with optional black formatting
 
         :param str content:
-        :param str config_path:
+        :param str file_path:
         """
+        # format before opening, so that a formatting error does not leave a truncated file behind
+        if self.black_formatting:
+            content = black.format_str(content, mode=black.Mode())
         with open(file_path, "wt", encoding="utf-8") as f:
-            if self.black_formatting:
-                content = black.format_str(content, mode=black.Mode())
             f.write(content)
 
     def _write_network_stages(self, config_path):
@@ -172,14 +232,11 @@ class ReturnnConfig:
         init_import_code = ""
         init_dict_code = "\n\nnetworks_dict = {\n"
 
+        pp = pprint.PrettyPrinter(indent=2, width=150, **self.pprint_kwargs)
         for epoch in self.staged_network_dict.keys():
             network_path = os.path.join(network_dir, "network_%i.py" % epoch)
-            pp = pprint.PrettyPrinter(indent=2, width=150, **self.pprint_kwargs)
             content = "\nnetwork = %s" % pp.pformat(self.staged_network_dict[epoch])
-            with open(network_path, "wt", encoding="utf-8") as f:
-                if self.black_formatting:
-                    content = black.format_str(content, mode=black.Mode())
-                f.write(content)
+            self._write_to_file(content, network_path)
             init_import_code += "from .network_%i import network as network_%i\n" % (
                 epoch,
                 epoch,
@@ -203,17 +260,28 @@ class ReturnnConfig:
         config_lines = []
         unreadable_data = {}
 
-        pp = pprint.PrettyPrinter(indent=2, width=150, **self.pprint_kwargs)
+        pp = _ReadabilityPrettyPrinter(indent=2, width=150, **self.pprint_kwargs)
+        pprint_kwargs = tuple(sorted(self.pprint_kwargs.items()))
         for k, v in sorted(config.items()):
-            if pprint.isreadable(v):
-                config_lines.append("%s = %s" % (k, pp.pformat(v)))
+            if type(v) in _CACHED_FORMAT_TYPES:
+                v_str, readable = _pformat_atomic(type(v), v, pprint_kwargs)
+            else:
+                v_str, readable = pp.pformat_readable(v)
+            if readable:
+                config_lines.append("%s = %s" % (k, v_str))
             else:
                 unreadable_data[k] = v
 
         if len(unreadable_data) > 0:
-            config_lines.append("import json")
-            json_data = json.dumps(unreadable_data).replace('"', '\\"')
-            config_lines.append('config = json.loads("%s")' % json_data)
+            config_lines.append("import base64")
+            config_lines.append("import pickle")
+            pickled_data = base64.b64encode(pickle.dumps(unreadable_data)).decode(
+                "utf8"
+            )
+            config_lines.append(
+                'config = pickle.loads(base64.b64decode("%s".encode("utf8")))'
+                % pickled_data
+            )
         else:
             config_lines.append("config = {}")
 
@@ -253,7 +321,7 @@ class ReturnnConfig:
             return "\n".join(self.__parse_python(v, name=k) for k, v in code.items())
         if inspect.isfunction(code):
             try:
-                return inspect.getsource(code)
+                return _get_source(code)
             except OSError:
                 # cannot get source, e.g. code is a lambda
                 assert name is not None
@@ -282,7 +350,7 @@ class ReturnnConfig:
                     % (compiled, name, code.__name__)
                 )
         if inspect.isclass(code):
-            return inspect.getsource(code)
+            return _get_source(code)
         raise RuntimeError("Could not serialize %s" % code)
 
     def check_consistency(self):
@@ -296,6 +364,9 @@ class ReturnnConfig:
         assert not (self.staged_network_dict and "network" in self.config)
 
     def _sis_hash(self):
+        # The hash is intentionally not cached on the instance: configs (or deep copies of them, which would copy a
+        # cached value as well) are commonly modified in place after being passed to a job, and a stale cached hash
+        # would silently map a different config onto an existing job.
         h = {
             "returnn_config": self.config,
             "python_epilog_hash": self.python_epilog_hash,
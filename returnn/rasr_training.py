@@ -39,6 +39,9 @@ class ReturnnRasrTrainingJob(ReturnnTrainingJob):
         mem_rqmt=4,
         cpu_rqmt=2,
         horovod_num_processes=None,
+        mpi_binding_args=None,
+        mpi_env=None,
+        horovod_max_cpu_rqmt=64,
         returnn_python_exe=None,
         returnn_root=None,
         # these are new parameters
@@ -69,6 +72,10 @@ class ReturnnRasrTrainingJob(ReturnnTrainingJob):
         :param int|float mem_rqmt:
         :param int cpu_rqmt:
         :param int horovod_num_processes:
+        :param list[str]|None mpi_binding_args: mpirun binding and mapping arguments, see ReturnnTrainingJob
+        :param dict[str, str|None]|None mpi_env: environment variables exported via mpirun, see ReturnnTrainingJob
+        :param int|None horovod_max_cpu_rqmt: upper limit for the total cpu_rqmt of all horovod processes,
+            see ReturnnTrainingJob
         :param Path|str returnn_python_exe: file path to the executable for running returnn (python binary or .sh)
         :param Path|str returnn_root: file path to the RETURNN repository root folder
         :param disregarded_classes:
@@ -97,6 +104,9 @@ class ReturnnRasrTrainingJob(ReturnnTrainingJob):
             mem_rqmt=mem_rqmt,
             cpu_rqmt=cpu_rqmt,
             horovod_num_processes=horovod_num_processes,
+            mpi_binding_args=mpi_binding_args,
+            mpi_env=mpi_env,
+            horovod_max_cpu_rqmt=horovod_max_cpu_rqmt,
             returnn_python_exe=returnn_python_exe,
             returnn_root=returnn_root,
         )
@@ -5,10 +5,17 @@ __all__ = [
     "ReturnnTrainingFromFileJob",
 ]
 
+import ast
+import concurrent.futures as futures
 import copy
+import functools
 import os
+import pickle
 import shutil
 import subprocess as sp
+import time
+
+import numpy as np
 
 from sisyphus import *
 
@@ -78,6 +85,22 @@ class ReturnnTrainingJob(Job):
         function of Returnn not all checkpoints are actually available.
     """
 
+    default_mpi_binding_args = [
+        "-bind-to",
+        "socket",
+        "-map-by",
+        "socket",
+        "-rank-by",
+        "core",
+    ]
+    # environment variables passed to the horovod processes, None exports the current value
+    default_mpi_env = {
+        "HOROVOD_FUSION_THRESHOLD": str(64 * 1024 * 1024),
+        "HOROVOD_CYCLE_TIME": "1",
+        "NCCL_DEBUG": "WARN",
+        "LD_LIBRARY_PATH": None,
+    }
+
     def __init__(
         self,
         returnn_config,
@@ -91,6 +114,9 @@ class ReturnnTrainingJob(Job):
         mem_rqmt=4,
         cpu_rqmt=2,
         horovod_num_processes=None,
+        mpi_binding_args=None,
+        mpi_env=None,
+        horovod_max_cpu_rqmt=64,
         returnn_python_exe=None,
         returnn_root=None,
     ):
@@ -107,13 +133,19 @@ class ReturnnTrainingJob(Job):
         :param int|float mem_rqmt:
         :param int cpu_rqmt:
         :param int horovod_num_processes:
+        :param list[str]|None mpi_binding_args: process binding and mapping arguments for mpirun when using horovod,
+            None uses default_mpi_binding_args which keep each process and its memory on a single NUMA node.
+            Use ["-bind-to", "none", "-map-by", "slot"] for unbound processes. Not hashed.
+        :param dict[str, str|None]|None mpi_env: environment variables exported to the horovod processes via mpirun,
+            a value of None exports the current value, None uses default_mpi_env which sets the tensor fusion
+            buffer and cycle time and enables NCCL warnings. Not hashed.
+        :param int|None horovod_max_cpu_rqmt: upper limit for the total cpu_rqmt of all horovod processes, to avoid
+            oversubscribing the host with intra-op threads. OMP_NUM_THREADS is set accordingly. None for no limit.
         :param Path|str returnn_python_exe: file path to the executable for running returnn (python binary or .sh)
         :param Path|str returnn_root: file path to the RETURNN repository root folder
         """
         assert isinstance(returnn_config, ReturnnConfig)
         self.check_blacklisted_parameters(returnn_config)
-        kwargs = locals()
-        del kwargs["self"]
 
         self.returnn_python_exe = (
             returnn_python_exe
@@ -125,15 +157,28 @@ class ReturnnTrainingJob(Job):
         )
         self.use_horovod = True if (horovod_num_processes is not None) else False
         self.horovod_num_processes = horovod_num_processes
-        self.returnn_config = ReturnnTrainingJob.create_returnn_config(**kwargs)
+        self.mpi_binding_args = list(
+            mpi_binding_args
+            if mpi_binding_args is not None
+            else self.default_mpi_binding_args
+        )
+        self.mpi_env = dict(mpi_env if mpi_env is not None else self.default_mpi_env)
+        self.returnn_config = ReturnnTrainingJob.create_returnn_config(
+            returnn_config=returnn_config,
+            log_verbosity=log_verbosity,
+            device=device,
+            num_epochs=num_epochs,
+            save_interval=save_interval,
+            horovod_num_processes=horovod_num_processes,
+        )
 
-        stored_epochs = list(range(save_interval, num_epochs, save_interval)) + [
-            num_epochs
-        ]
+        stored_epochs = set(range(save_interval, num_epochs, save_interval))
+        stored_epochs.add(num_epochs)
         if keep_epochs is None:
-            self.keep_epochs = set(stored_epochs)
+            self.keep_epochs = stored_epochs
         else:
             self.keep_epochs = set(keep_epochs)
+        kept_epochs = sorted(stored_epochs & self.keep_epochs)
 
         suffix = ".meta" if self.returnn_config.get("use_tensorflow", False) else ""
 
@@ -146,14 +191,12 @@ class ReturnnTrainingJob(Job):
                 self.output_path("models/epoch.%.3d%s" % (k, suffix)),
                 k,
             )
-            for k in stored_epochs
-            if k in self.keep_epochs
+            for k in kept_epochs
         }
         if self.returnn_config.get("use_tensorflow", False):
             self.out_checkpoints = {
                 k: Checkpoint(index_path)
-                for k in stored_epochs
-                if k in self.keep_epochs
+                for k in kept_epochs
                 for index_path in [self.output_path("models/epoch.%.3d.index" % k)]
             }
         self.out_plot_se = self.output_path("score_and_error.png")
@@ -172,8 +215,15 @@ class ReturnnTrainingJob(Job):
 
         if self.use_horovod:
             self.rqmt["cpu"] *= self.horovod_num_processes
+            if horovod_max_cpu_rqmt is not None:
+                self.rqmt["cpu"] = min(self.rqmt["cpu"], horovod_max_cpu_rqmt)
             self.rqmt["gpu"] *= self.horovod_num_processes
             self.rqmt["mem"] *= self.horovod_num_processes
+            # limit the threads of each process to its share of the requested cpus
+            self.mpi_env.setdefault(
+                "OMP_NUM_THREADS",
+                str(max(1, self.rqmt["cpu"] // self.horovod_num_processes)),
+            )
 
     def _get_run_cmd(self):
         run_cmd = [
@@ -183,22 +233,33 @@ class ReturnnTrainingJob(Job):
         ]
 
         if self.use_horovod:
-            run_cmd = [
-                "mpirun",
-                "-np",
-                str(self.horovod_num_processes),
-                "-bind-to",
-                "none",
-                "-map-by",
-                "slot",
-                "-mca",
-                "pml",
-                "ob1",
-                "-mca",
-                "btl",
-                "^openib",
-                "--report-bindings",
-            ] + run_cmd
+            # jobs pickled before mpi_binding_args and mpi_env were added keep their original command
+            mpi_binding_args = getattr(
+                self, "mpi_binding_args", ["-bind-to", "none", "-map-by", "slot"]
+            )
+            run_cmd = (
+                [
+                    "mpirun",
+                    "-np",
+                    str(self.horovod_num_processes),
+                ]
+                + mpi_binding_args
+                + [
+                    arg
+                    for k, v in getattr(self, "mpi_env", {}).items()
+                    for arg in ["-x", k if v is None else "%s=%s" % (k, v)]
+                ]
+                + [
+                    "-mca",
+                    "pml",
+                    "ob1",
+                    "-mca",
+                    "btl",
+                    "^openib",
+                    "--report-bindings",
+                ]
+                + run_cmd
+            )
 
         return run_cmd
 
@@ -213,7 +274,7 @@ class ReturnnTrainingJob(Job):
             return super().path_available(path)
 
         # maybe the file already exists
-        res = os.path.exists(path.get_path())
+        res = _path_exists_in_snapshot(path.get_path())
         if res:
             return res
 
@@ -224,7 +285,7 @@ class ReturnnTrainingJob(Job):
             segments = file.split(".")
             pretrain_file = ".".join([segments[0], "pretrain", segments[1]])
             pretrain_path = os.path.join(directory, pretrain_file)
-            return os.path.exists(pretrain_path)
+            return _path_exists_in_snapshot(pretrain_path)
 
         return False
 
@@ -240,9 +301,16 @@ class ReturnnTrainingJob(Job):
 
     @staticmethod
     def _relink(src, dst):
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.link(src, dst)
+        # Hard link to a temporary name and rename it, so that dst is replaced atomically.
+        # A symlink is not used as it would break when the work folder is cleaned up.
+        tmp = dst + ".tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+        if os.path.lexists(tmp):
+            # rename does nothing if tmp and dst are already links to the same file
+            os.remove(tmp)
 
     def run(self):
         sp.check_call(self._get_run_cmd())
@@ -252,59 +320,44 @@ class ReturnnTrainingJob(Job):
 
         # cleanup
         if hasattr(self, "keep_epochs"):
+            keep_epochs = self.keep_epochs
+            to_delete = []
             for e in os.scandir(self.out_model_dir.get_path()):
                 if e.is_file() and e.name.startswith("epoch."):
-                    s = e.name.split(".")
-                    idx = 2 if s[1] == "pretrain" else 1
-                    epoch = int(s[idx])
-                    if epoch not in self.keep_epochs:
-                        os.unlink(e.path)
+                    # epoch.[pretrain.]<epoch>[.<suffix>]
+                    name = e.name[len("epoch.") :]
+                    if name.startswith("pretrain."):
+                        name = name[len("pretrain.") :]
+                    epoch = int(name.partition(".")[0])
+                    if epoch not in keep_epochs:
+                        to_delete.append(e.path)
+
+            # deleting is dominated by metadata latency on network file systems, so do it concurrently
+            with futures.ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(os.unlink, to_delete))  # consume to raise errors
 
     def plot(self):
-        def EpochData(learningRate, error):
-            return {"learning_rate": learningRate, "error": error}
-
-        with open(self.out_learning_rates.get_path(), "rt") as f:
-            text = f.read()
-
-        data = eval(text)
+        data = self._load_learning_rates()
 
         epochs = list(sorted(data.keys()))
-        train_score_keys = [
-            k for k in data[epochs[0]]["error"] if k.startswith("train_score")
-        ]
-        dev_score_keys = [
-            k for k in data[epochs[0]]["error"] if k.startswith("dev_score")
-        ]
-        dev_error_keys = [
-            k for k in data[epochs[0]]["error"] if k.startswith("dev_error")
-        ]
 
-        train_scores = [
-            [
-                (epoch, data[epoch]["error"][tsk])
-                for epoch in epochs
-                if tsk in data[epoch]["error"]
-            ]
-            for tsk in train_score_keys
-        ]
-        dev_scores = [
-            [
-                (epoch, data[epoch]["error"][dsk])
-                for epoch in epochs
-                if dsk in data[epoch]["error"]
-            ]
-            for dsk in dev_score_keys
-        ]
-        dev_errors = [
-            [
-                (epoch, data[epoch]["error"][dek])
-                for epoch in epochs
-                if dek in data[epoch]["error"]
-            ]
-            for dek in dev_error_keys
-        ]
-        learing_rates = [data[epoch]["learning_rate"] for epoch in epochs]
+        # the keys of the first epoch define the plotted series, fill all of them in a single pass
+        series = {k: [] for k in data[epochs[0]]["error"]}
+        for epoch in epochs:
+            for k, v in data[epoch]["error"].items():
+                if k in series:
+                    series[k].append((epoch, v))
+        # rows of (epoch, value), which can be passed to matplotlib column-wise
+        series = {
+            k: np.array(s, dtype=np.float64).reshape(-1, 2) for k, s in series.items()
+        }
+
+        train_scores = [s for k, s in series.items() if k.startswith("train_score")]
+        dev_scores = [s for k, s in series.items() if k.startswith("dev_score")]
+        dev_errors = [s for k, s in series.items() if k.startswith("dev_error")]
+        learing_rates = np.array(
+            [data[epoch]["learning_rate"] for epoch in epochs], dtype=np.float64
+        )
 
         colors = ["#2A4D6E", "#AA3C39", "#93A537"]  # blue red yellowgreen
 
@@ -315,9 +368,9 @@ class ReturnnTrainingJob(Job):
 
         fig, ax1 = plt.subplots()
         for ts in train_scores:
-            ax1.plot([d[0] for d in ts], [d[1] for d in ts], "o-", color=colors[0])
+            ax1.plot(ts[:, 0], ts[:, 1], "o-", color=colors[0])
         for ds in dev_scores:
-            ax1.plot([d[0] for d in ds], [d[1] for d in ds], "o-", color=colors[1])
+            ax1.plot(ds[:, 0], ds[:, 1], "o-", color=colors[1])
         ax1.set_xlabel("epoch")
         ax1.set_ylabel("scores", color=colors[0])
         for tl in ax1.get_yticklabels():
@@ -327,18 +380,75 @@ class ReturnnTrainingJob(Job):
             ax2 = ax1.twinx()
             ax2.set_ylabel("dev error", color=colors[2])
             for de in dev_errors:
-                ax2.plot([d[0] for d in de], [d[1] for d in de], "o-", color=colors[2])
+                ax2.plot(de[:, 0], de[:, 1], "o-", color=colors[2])
             for tl in ax2.get_yticklabels():
                 tl.set_color(colors[2])
 
         fig.savefig(fname=self.out_plot_se.get_path())
 
-        fig, ax1 = plt.subplots()
+        # reuse the figure for the second plot
+        fig.clear()
+        ax1 = fig.add_subplot(111)
         ax1.semilogy(epochs, learing_rates, "ro-")
         ax1.set_xlabel("epoch")
         ax1.set_ylabel("learning_rate")
 
         fig.savefig(fname=self.out_plot_lr.get_path())
+        plt.close(fig)
+
+    def _load_learning_rates(self, cache_file="learning_rates.cache.pkl"):
+        """
+        Load the parsed learning rates file, re-using the parse result of a previous call
+        if the file did not change since then
+
+        :param str cache_file: pickle file in the work directory storing the last parse result
+        :return: see _parse_learning_rates
+        :rtype: dict[int, dict[str]]
+        """
+        path = self.out_learning_rates.get_path()
+        stat = os.stat(path)
+        cache_key = (path, stat.st_mtime_ns, stat.st_size)
+
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "rb") as f:
+                    cached_key, cached_data = pickle.load(f)
+                if cached_key == cache_key:
+                    return cached_data
+            except Exception:
+                pass  # any unusable cache (broken, wrong format, stale classes), just parse again
+
+        with open(path, "rt") as f:
+            data = self._parse_learning_rates(f.read())
+        with open(cache_file, "wb") as f:
+            pickle.dump((cache_key, data), f)
+        return data
+
+    @staticmethod
+    def _parse_learning_rates(text):
+        """
+        Parse the content of a RETURNN learning rates file without executing it as code
+
+        :param str text: python dict of epoch -> EpochData(learningRate=..., error={...})
+        :return: dict of epoch -> {"learning_rate": ..., "error": {...}}
+        :rtype: dict[int, dict[str]]
+        """
+        tree = ast.parse(text, mode="eval")
+        assert isinstance(tree.body, ast.Dict), "learning rates file is not a dict"
+        data = {}
+        for key, value in zip(tree.body.keys, tree.body.values):
+            assert (
+                isinstance(value, ast.Call)
+                and isinstance(value.func, ast.Name)
+                and value.func.id == "EpochData"
+            ), "unexpected entry in learning rates file"
+            epoch_data = dict(zip(["learningRate", "error"], value.args))
+            epoch_data.update({kw.arg: kw.value for kw in value.keywords})
+            data[ast.literal_eval(key)] = {
+                "learning_rate": ast.literal_eval(epoch_data["learningRate"]),
+                "error": ast.literal_eval(epoch_data["error"]),
+            }
+        return data
 
     @classmethod
     def create_returnn_config(
@@ -353,7 +463,18 @@ class ReturnnTrainingJob(Job):
     ):
         assert device in ["gpu", "cpu"]
 
-        res = copy.deepcopy(returnn_config)
+        # config and post_config are replaced below, so only the other attributes (e.g. staged_network_dict or
+        # python_epilog) are deep copied, otherwise later changes to the user config would alter the job
+        res = copy.copy(returnn_config)
+        res.__dict__.update(
+            copy.deepcopy(
+                {
+                    k: v
+                    for k, v in vars(returnn_config).items()
+                    if k not in ("config", "post_config")
+                }
+            )
+        )
 
         config = {
             "task": "train",
@@ -372,8 +493,10 @@ class ReturnnTrainingJob(Job):
         if horovod_num_processes is not None:
             config["use_horovod"] = True
 
+        # the values are deep copied so that modifying the nested user config after creating the job
+        # does not alter the config of the already hashed job
         config.update(copy.deepcopy(returnn_config.config))
-        if returnn_config.post_config is not None:
+        if returnn_config.post_config:
             post_config.update(copy.deepcopy(returnn_config.post_config))
 
         res.config = config
@@ -404,6 +527,8 @@ class ReturnnTrainingJob(Job):
 
     @classmethod
     def hash(cls, kwargs):
+        # The config is passed as object so that its _sis_hash is used. Replacing it by e.g. a json digest would
+        # change the hash of every existing training and can not represent Paths/Variables or code objects.
         d = {
             "returnn_config": ReturnnTrainingJob.create_returnn_config(**kwargs),
             "returnn_python_exe": kwargs["returnn_python_exe"],
@@ -492,7 +617,7 @@ class ReturnnTrainingFromFileJob(Job):
             return super().path_available(path)
 
         # maybe the file already exists
-        res = os.path.exists(path.get_path())
+        res = _path_exists_in_snapshot(path.get_path())
         if res:
             return res
 
@@ -503,7 +628,7 @@ class ReturnnTrainingFromFileJob(Job):
             segments = file.split(".")
             pretrain_file = ".".join([segments[0], "pretrain", segments[1]])
             pretrain_path = os.path.join(directory, pretrain_file)
-            return os.path.exists(pretrain_path)
+            return _path_exists_in_snapshot(pretrain_path)
 
         return False
 
@@ -522,8 +647,7 @@ class ReturnnTrainingFromFileJob(Job):
             else:
                 v = str(v)
 
-            parameter_list.append("++%s" % k)
-            parameter_list.append(v)
+            parameter_list.extend(("++" + k, v))
 
         return parameter_list
 
@@ -557,3 +681,34 @@ class ReturnnTrainingFromFileJob(Job):
         }
 
         return super().hash(d)
+
+
+_DIR_SNAPSHOT_TTL = 5
+
+
+@functools.lru_cache(maxsize=8)
+def _list_dir_snapshot(directory, time_bucket):
+    """
+    :param str directory:
+    :param int time_bucket: only used as part of the cache key, so the listing is refreshed every _DIR_SNAPSHOT_TTL s
+    :return: names of all entries in directory, empty if it does not exist (yet) or can not be read
+    :rtype: frozenset[str]
+    """
+    try:
+        with os.scandir(directory) as it:
+            return frozenset(entry.name for entry in it)
+    except OSError:
+        # same as os.path.exists, which reports any error (e.g. a stale NFS handle) as not existing
+        return frozenset()
+
+
+def _path_exists_in_snapshot(path):
+    """
+    Checks the existence of path against a recent listing of its directory. path_available is polled for all
+    model outputs of a training, so this replaces a stat call per output and poll by one listing per directory.
+
+    :param str path:
+    :rtype: bool
+    """
+    directory, file = os.path.split(path)
+    return file in _list_dir_snapshot(directory, int(time.time() // _DIR_SNAPSHOT_TTL))
@@ -247,17 +247,19 @@ def create_executable(filename, command):
     """
     assert filename.endswith(".sh")
     with open(filename, "wt") as f:
+        # the content is small enough to be flushed with a single write on close,
+        # set the mode via the open file descriptor instead of resolving the path again
         f.write("#!/usr/bin/env bash\n%s" % " ".join(command))
-    os.chmod(
-        filename,
-        stat.S_IRUSR
-        | stat.S_IRGRP
-        | stat.S_IROTH
-        | stat.S_IWUSR
-        | stat.S_IXUSR
-        | stat.S_IXGRP
-        | stat.S_IXOTH,
-    )
+        os.fchmod(
+            f.fileno(),
+            stat.S_IRUSR
+            | stat.S_IRGRP
+            | stat.S_IROTH
+            | stat.S_IWUSR
+            | stat.S_IXUSR
+            | stat.S_IXGRP
+            | stat.S_IXOTH,
+        )
 
 
 def check_file_sha256_checksum(filename, reference_checksum):